@@ -4,85 +4,323 @@ import random
 import json
 import logging
 import uuid
-from datetime import datetime, timedelta
-import zipfile
-import io
-from flask import Flask, request, render_template, send_from_directory, send_file, jsonify
-from pydub import AudioSegment
-from functools import wraps
+import hashlib
+import sqlite3
+import copy
+import subprocess
+import re
+import heapq
+import shutil
+import unicodedata
+from itertools import cycle
+from queue import Queue, Full
+from concurrent.futures import ThreadPoolExecutor, wait
+from flask import Flask, Response, request, render_template, send_from_directory, jsonify
+from functools import wraps, lru_cache
 import yt_dlp
+from zipstream import ZipStream, ZIP_STORED, ZIP_DEFLATED
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from spotipy.oauth2 import SpotifyClientCredentials
 import spotipy
-from threading import Thread
+from spotipy.exceptions import SpotifyException
+import requests
+from threading import Thread, Lock, Condition, local
 
 # Flask app setup
 app = Flask(__name__)
-BASE_DOWNLOAD_FOLDER = './downloads'
+# Paths are relative to the app, so send_from_directory and plain file access agree
+# regardless of the working directory
+BASE_DOWNLOAD_FOLDER = os.path.join(app.root_path, 'downloads')
 app.config['BASE_DOWNLOAD_FOLDER'] = BASE_DOWNLOAD_FOLDER
+# Behind Apache with mod_xsendfile (or lighttpd), let the server send files itself via X-Sendfile.
+# nginx ignores X-Sendfile and would serve empty files, so leave this off there.
+app.use_x_sendfile = os.environ.get('USE_X_SENDFILE') == '1'
+os.makedirs(BASE_DOWNLOAD_FOLDER, exist_ok=True)
+MAX_FILE_AGE = 5 * 24 * 3600  # 5 days, in seconds
+TITLES_FILENAME = 'titles.json'  # Maps each file stem in a user folder to its track title
+MAX_CONCURRENT_DOWNLOADS = 8  # Keeps YouTube API quota usage in check
+MAX_CONCURRENT_CONVERSIONS = os.cpu_count() or 1  # One ffmpeg encoder per core
+MAX_CONCURRENT_PLAYLISTS = 2  # Playlists in progress at once; their tracks share the pools below
+MAX_QUEUED_PLAYLISTS = 20  # New playlists are turned away while this many are waiting
+SPOTIFY_PAGE_SIZE = 100  # Maximum page size of the playlist items endpoint
+SPOTIFY_TRACK_FIELDS = 'items(track(name,artists(name))),total'
+# Playlist IDs are 22 base62 characters, in open.spotify.com URLs or spotify: URIs
+SPOTIFY_PLAYLIST_ID_PATTERN = re.compile(r'(?:/playlist/|^spotify:playlist:)([A-Za-z0-9]{22})(?:[/?#]|$)')
+SPOTIFY_PAGE_CONCURRENCY = 8  # Stays within the 10 connections spotipy's session keeps per host
+MAX_RETRY_DELAY = 30  # Upper bound for the exponential backoff, in seconds
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+YOUTUBE_CACHE_TTL = 30 * 24 * 3600  # Cached search results are trusted for 30 days, in seconds
+QUOTA_COOLDOWN = 3600  # How long to skip a YouTube API key after it runs out of quota, in seconds
 
 # Logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Load configuration
-with open('config.json', 'r') as f:
-    config = json.load(f)
+# Load configuration, failing at startup rather than on the first request if it is malformed
+def load_config(path):
+    with open(path, 'r') as f:
+        config = json.load(f)
+    for key in ('spotifyClientId', 'spotifyClientSecret'):
+        if not isinstance(config.get(key), str) or not config[key]:
+            raise ValueError(f"{path}: '{key}' must be a non-empty string")
+    # An empty key list is allowed; searches then go straight to yt-dlp
+    api_keys = config.get('youtubeApiKeys')
+    if not isinstance(api_keys, list) or not all(isinstance(k, str) and k for k in api_keys):
+        raise ValueError(f"{path}: 'youtubeApiKeys' must be a list of non-empty strings")
+    return config
 
-# Spotify API setup
-sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=config['spotifyClientId'],
-                                                            client_secret=config['spotifyClientSecret']))
+config = load_config(os.path.join(app.root_path, 'config.json'))
+SPOTIFY_CLIENT_ID = config['spotifyClientId']
+SPOTIFY_CLIENT_SECRET = config['spotifyClientSecret']
+YOUTUBE_API_KEYS = tuple(config['youtubeApiKeys'])
 
-# Retry decorator
+# Spotify API setup; spotipy keeps its own keep-alive session, which also retries 429/5xx responses
+sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(client_id=SPOTIFY_CLIENT_ID,
+                                                            client_secret=SPOTIFY_CLIENT_SECRET))
+
+# YouTube search cache (query -> video URL), shared by all playlists and workers
+YOUTUBE_CACHE_PATH = os.path.join(app.root_path, 'ytcache.db')
+cache_lock = Lock()
+cache_db = sqlite3.connect(YOUTUBE_CACHE_PATH, check_same_thread=False)
+cache_db.execute('CREATE TABLE IF NOT EXISTS cache (q TEXT PRIMARY KEY, url TEXT, fetched_at REAL)')
+# Caches created before entries were timestamped; their rows count as expired
+if 'fetched_at' not in [row[1] for row in cache_db.execute('PRAGMA table_info(cache)')]:
+    cache_db.execute('ALTER TABLE cache ADD COLUMN fetched_at REAL NOT NULL DEFAULT 0')
+
+# YouTube API keys are used in turn; keys that ran out of quota are skipped until their cooldown ends
+youtube_key_lock = Lock()
+youtube_keys = cycle(YOUTUBE_API_KEYS)
+exhausted_youtube_keys = {}  # API key -> time it can be used again
+
+# User folders ordered by when they expire, as a heap of (expiry time, folder path)
+folder_expiry = []
+folder_expiry_changed = Condition()
+
+# Playlist jobs waiting for a job worker, and the progress of each job by user ID
+job_queue = Queue(maxsize=MAX_QUEUED_PLAYLISTS)
+progress_lock = Lock()
+job_progress = {}
+
+# Download and conversion pools shared by all playlist jobs, so the limits above hold app-wide
+# and each pool thread keeps its API clients and YoutubeDL instances from one playlist to the next.
+# Downloads are network-bound and conversions CPU-bound, so each gets its own pool
+# and a download slot is freed as soon as its file is handed to an encoder.
+download_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS, thread_name_prefix='download')
+convert_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CONVERSIONS, thread_name_prefix='convert')
+spotify_page_executor = ThreadPoolExecutor(max_workers=SPOTIFY_PAGE_CONCURRENCY, thread_name_prefix='spotify')
+
+# Per-thread state; API clients and YoutubeDL instances are not safe to share between threads
+thread_state = local()
+
+# yt-dlp options; each thread builds its YoutubeDL instances from these once.
+# Downloads only fetch the audio stream, MP3 encoding runs separately in convert_to_mp3.
+YDL_SEARCH_OPTS = {'quiet': True, 'skip_download': True, 'noplaylist': True, 'extract_flat': 'in_playlist'}
+YDL_DOWNLOAD_OPTS = {
+    'format': 'bestaudio/best',
+    # The output template is filled in per download
+    'outtmpl': {'default': '%(title)s.%(ext)s'},
+    'noplaylist': True,
+}
+
+# Work out how long to wait before retrying after an error, or None if retrying won't help
+def get_retry_delay(error, attempt, backoff_factor, jitter):
+    status, retry_after = None, None
+    if isinstance(error, HttpError):
+        status, retry_after = error.resp.status, error.resp.get('retry-after')
+    elif isinstance(error, SpotifyException):
+        status, retry_after = error.http_status, (error.headers or {}).get('Retry-After')
+    elif isinstance(error, requests.RequestException) and error.response is not None:
+        status, retry_after = error.response.status_code, error.response.headers.get('Retry-After')
+    elif isinstance(error, yt_dlp.utils.DownloadError):
+        # Expected extractor errors (unavailable, private, geo-blocked videos) won't go away
+        cause = error.exc_info[1] if error.exc_info else None
+        if isinstance(cause, yt_dlp.utils.ExtractorError) and cause.expected:
+            return None
+    elif not isinstance(error, (requests.RequestException, TimeoutError, ConnectionError)):
+        # Anything else (e.g. no search results) fails the same way every time
+        return None
+
+    if status is not None and status not in RETRYABLE_STATUS_CODES:
+        return None
+    if status == 429 and retry_after and str(retry_after).isdigit():
+        # Don't hold a worker for a long rate-limit window; give up and let the caller fall back
+        return float(retry_after) if float(retry_after) <= MAX_RETRY_DELAY else None
+    delay = min(MAX_RETRY_DELAY, backoff_factor ** attempt)
+    if jitter:
+        delay += random.uniform(0, 1)
+    return delay
+
+# Retry decorator; only transient errors (timeouts, connection errors, 429/5xx) are retried
 def retry_on_failure(retries=5, backoff_factor=2, jitter=True):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
             attempt = 0
-            while attempt < retries:
+            while True:
                 try:
                     return func(*args, **kwargs)
                 except Exception as e:
                     attempt += 1
-                    delay = backoff_factor ** attempt
-                    if jitter:
-                        delay += random.uniform(0, 1)
+                    delay = get_retry_delay(e, attempt, backoff_factor, jitter)
+                    if delay is None:
+                        raise
+                    if attempt >= retries:
+                        raise Exception(f"{func.__name__} failed after {retries} retries.") from e
                     logging.warning(f"Error in {func.__name__}: {e}. Retrying in {delay:.2f} seconds...")
                     time.sleep(delay)
-            raise Exception(f"{func.__name__} failed after {retries} retries.")
         return wrapper
     return decorator
 
-# Cleanup old files (older than 5 days)
+# Schedule a user folder for deletion once it expires
+def schedule_folder_cleanup(user_folder, expires_at):
+    with folder_expiry_changed:
+        heapq.heappush(folder_expiry, (expires_at, user_folder))
+        folder_expiry_changed.notify()
+
+# Delete user folders once their newest file is older than MAX_FILE_AGE (5 days)
 def cleanup_old_files():
+    # Pick up folders left from before a restart; a folder's mtime is when its last file was added
+    # Other gunicorn workers may delete folders while this runs, so vanished ones are skipped
+    with os.scandir(BASE_DOWNLOAD_FOLDER) as folders:
+        for folder in folders:
+            try:
+                if folder.is_dir(follow_symlinks=False):
+                    schedule_folder_cleanup(folder.path, folder.stat().st_mtime + MAX_FILE_AGE)
+            except FileNotFoundError:
+                continue
+
     while True:
-        now = datetime.now()
-        for folder in os.listdir(BASE_DOWNLOAD_FOLDER):
-            folder_path = os.path.join(BASE_DOWNLOAD_FOLDER, folder)
-            if os.path.isdir(folder_path):
-                for file in os.listdir(folder_path):
-                    file_path = os.path.join(folder_path, file)
-                    if os.path.isfile(file_path):
-                        file_age = now - datetime.fromtimestamp(os.path.getmtime(file_path))
-                        if file_age > timedelta(days=5):
-                            os.remove(file_path)
-                            logging.info(f"Deleted old file: {file_path}")
-                # Remove the folder if empty
-                if not os.listdir(folder_path):
-                    os.rmdir(folder_path)
-        time.sleep(3600)  # Run cleanup every hour
+        # Sleep until the next folder is due, or a new folder is scheduled
+        with folder_expiry_changed:
+            while not folder_expiry or folder_expiry[0][0] > time.time():
+                timeout = folder_expiry[0][0] - time.time() if folder_expiry else None
+                folder_expiry_changed.wait(timeout)
+            _, user_folder = heapq.heappop(folder_expiry)
+
+        # One bad folder must not end cleanup for the rest of the worker's life
+        try:
+            expire_folder(user_folder)
+        except Exception as e:
+            logging.error(f"Error cleaning up {user_folder}: {e}")
+
+# Delete a due user folder, or push its expiry back if files were added since it was scheduled
+def expire_folder(user_folder):
+    try:
+        mtime = os.stat(user_folder).st_mtime
+    except FileNotFoundError:
+        return
+    if mtime + MAX_FILE_AGE > time.time():
+        schedule_folder_cleanup(user_folder, mtime + MAX_FILE_AGE)
+        return
+    shutil.rmtree(user_folder, ignore_errors=True)
+    logging.info(f"Deleted expired folder: {user_folder}")
+    with progress_lock:
+        job_progress.pop(os.path.basename(user_folder), None)
+
+# Turn a track title into an ASCII, filesystem-safe file stem
+def slugify(text):
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode()
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', text).strip('._')[:120] or 'track'
+
+# Pick file stems for a playlist, skipping repeated tracks and keeping distinct titles apart
+def build_track_titles(tracks):
+    titles = {}
+    for track in tracks:
+        query = f"{track['name']} {track['artist']}"
+        base_stem = stem = slugify(query)
+        suffix = 1
+        while stem in titles and titles[stem] != query:
+            suffix += 1
+            stem = f"{base_stem}_{suffix}"
+        titles[stem] = query
+    return titles
+
+# Look up a cached YouTube video URL for a search query, or None if there is no fresh entry.
+# Cache errors (e.g. the database is locked by another worker) count as a miss.
+def get_cached_video_url(query):
+    key = hashlib.sha1(query.encode('utf-8')).hexdigest()
+    try:
+        with cache_lock:
+            row = cache_db.execute('SELECT url FROM cache WHERE q = ? AND fetched_at > ?',
+                                   (key, time.time() - YOUTUBE_CACHE_TTL)).fetchone()
+    except sqlite3.Error as e:
+        logging.warning(f"Could not read cached video for '{query}': {e}")
+        return None
+    return row[0] if row else None
+
+# Remember the YouTube video URL found for a search query
+def cache_video_url(query, video_url):
+    key = hashlib.sha1(query.encode('utf-8')).hexdigest()
+    try:
+        with cache_lock, cache_db:
+            cache_db.execute('INSERT OR REPLACE INTO cache (q, url, fetched_at) VALUES (?, ?, ?)',
+                             (key, video_url, time.time()))
+    except sqlite3.Error as e:
+        logging.warning(f"Could not cache video for '{query}': {e}")
+
+# Drop the cached video URL for a search query, e.g. once the video has been taken down
+def forget_video_url(query):
+    key = hashlib.sha1(query.encode('utf-8')).hexdigest()
+    try:
+        with cache_lock, cache_db:
+            cache_db.execute('DELETE FROM cache WHERE q = ?', (key,))
+    except sqlite3.Error as e:
+        logging.warning(f"Could not remove cached video for '{query}': {e}")
+
+# Pick the next YouTube API key that still has quota left, or None if all are exhausted
+def next_youtube_key():
+    with youtube_key_lock:
+        now = time.time()
+        for _ in range(len(YOUTUBE_API_KEYS)):
+            api_key = next(youtube_keys)
+            if exhausted_youtube_keys.get(api_key, 0) <= now:
+                return api_key
+    return None
+
+# Skip a YouTube API key until its quota has had time to recover
+def mark_youtube_key_exhausted(api_key):
+    with youtube_key_lock:
+        exhausted_youtube_keys[api_key] = time.time() + QUOTA_COOLDOWN
+    logging.warning(f"YouTube API key ...{api_key[-4:]} is out of quota, skipping it for {QUOTA_COOLDOWN} seconds.")
+
+# Get this thread's YouTube API client for a key, building it on first use
+def get_youtube_client(api_key):
+    clients = getattr(thread_state, 'youtube_clients', None)
+    if clients is None:
+        clients = thread_state.youtube_clients = {}
+    if api_key not in clients:
+        clients[api_key] = build("youtube", "v3", developerKey=api_key)
+    return clients[api_key]
+
+# Get this thread's YoutubeDL instance for the given options, creating it on first use
+def get_youtube_dl(name, opts):
+    ydl = getattr(thread_state, name, None)
+    if ydl is None:
+        ydl = yt_dlp.YoutubeDL(copy.deepcopy(opts))
+        setattr(thread_state, name, ydl)
+    return ydl
+
+# Get the playlist ID from a Spotify playlist URL or URI, or None if it isn't one
+def parse_playlist_id(playlist_url):
+    match = SPOTIFY_PLAYLIST_ID_PATTERN.search(playlist_url.strip())
+    return match.group(1) if match else None
 
 # Fetch Spotify playlist tracks
 @retry_on_failure()
-def fetch_spotify_playlist_tracks(playlist_url):
-    playlist_id = playlist_url.split('/playlist/')[1].split('?')[0]
-    results = sp.playlist_tracks(playlist_id)
-    tracks = []
+def fetch_spotify_playlist_tracks(playlist_id):
+    def fetch_page(offset):
+        return sp.playlist_items(playlist_id, fields=SPOTIFY_TRACK_FIELDS, limit=SPOTIFY_PAGE_SIZE,
+                                 offset=offset, additional_types=('track',))
 
-    while results:
-        for item in results['items']:
-            track = item['track']
-            tracks.append({'name': track['name'], 'artist': track['artists'][0]['name']})
-        results = sp.next(results) if results['next'] else None
+    # The first page tells us the total, the remaining pages are fetched concurrently
+    first_page = fetch_page(0)
+    offsets = range(SPOTIFY_PAGE_SIZE, first_page['total'], SPOTIFY_PAGE_SIZE)
+    pages = [first_page, *spotify_page_executor.map(fetch_page, offsets)]
+
+    tracks = []
+    for page in pages:
+        tracks.extend({'name': item['track']['name'], 'artist': item['track']['artists'][0]['name']}
+                      for item in page['items'] if item['track'])
 
     logging.info(f"Fetched {len(tracks)} tracks from Spotify.")
     return tracks
@@ -90,12 +328,25 @@ def fetch_spotify_playlist_tracks(playlist_url):
 # Search YouTube for a video using the YouTube API (primary method)
 @retry_on_failure()
 def search_youtube_api(query):
-    youtube = build("youtube", "v3", developerKey=random.choice(config["youtubeApiKeys"]))
-    search_response = youtube.search().list(q=query, part="id,snippet", maxResults=1).execute()
+    # Move on to the next key when one runs out of quota; other errors go to the retry decorator
+    while True:
+        api_key = next_youtube_key()
+        if api_key is None:
+            raise Exception("No YouTube API key with quota left")
+        youtube = get_youtube_client(api_key)
+        try:
+            search_response = youtube.search().list(q=query, part="id,snippet", maxResults=1).execute()
+            break
+        except HttpError as e:
+            if e.resp.status == 403 and 'quota' in str(e).lower():
+                mark_youtube_key_exhausted(api_key)
+                continue
+            raise
 
     if 'items' in search_response and search_response['items']:
         video_url = "https://www.youtube.com/watch?v=" + search_response['items'][0]['id']['videoId']
         logging.info(f"Found video for '{query}' using YouTube API: {video_url}")
+        cache_video_url(query, video_url)
         return video_url
     else:
         raise Exception(f"No YouTube results found for '{query}'")
@@ -104,64 +355,151 @@ def search_youtube_api(query):
 @retry_on_failure()
 def search_youtube_yt_dlp(query):
     logging.info(f"Searching for '{query}' on YouTube using yt-dlp...")
-    ydl_opts = {'quiet': True, 'extractaudio': True, 'format': 'bestaudio/best', 'noplaylist': True}
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        result = ydl.extract_info(f"ytsearch:{query}", download=False)
-        if 'entries' in result and len(result['entries']) > 0:
-            video_url = result['entries'][0]['url']
-            logging.info(f"Found video for '{query}' using yt-dlp: {video_url}")
-            return video_url
-        else:
-            raise Exception(f"No results found for '{query}'")
-
-# Download a song from YouTube
+    ydl = get_youtube_dl('ydl_search', YDL_SEARCH_OPTS)
+    result = ydl.extract_info(f"ytsearch:{query}", download=False)
+    if 'entries' in result and len(result['entries']) > 0:
+        video_url = result['entries'][0]['url']
+        logging.info(f"Found video for '{query}' using yt-dlp: {video_url}")
+        return video_url
+    else:
+        raise Exception(f"No results found for '{query}'")
+
+# Download a song's audio stream from YouTube, returning the downloaded file path
 @retry_on_failure()
-def download_song(video_url, query, output_dir):
-    output_path = os.path.join(output_dir, f"{query}.webm")
-    ydl_opts = {'format': 'bestaudio/best', 'outtmpl': output_path, 'noplaylist': False}
-
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        logging.info(f"Downloading {query}...")
-        ydl.download([video_url])
-    logging.info(f"Downloaded {query} successfully.")
-    convert_to_mp3(output_path, query, output_dir)
-
-# Convert downloaded audio to MP3
-def convert_to_mp3(input_file, query, output_dir):
+def download_song(video_url, stem, output_dir):
+    ydl = get_youtube_dl('ydl_download', YDL_DOWNLOAD_OPTS)
+    ydl.params['outtmpl']['default'] = os.path.join(output_dir, f"{stem}.%(ext)s")
+    logging.info(f"Downloading {stem}...")
+    info = ydl.extract_info(video_url, download=True)
+    logging.info(f"Downloaded {stem} successfully.")
+    return ydl.prepare_filename(info)
+
+# Update the progress of a playlist job
+def update_progress(user_id, **fields):
+    with progress_lock:
+        job_progress[user_id].update(fields)
+
+# Count a track as finished, whether or not it made it to an MP3
+def finish_track(user_id, succeeded):
+    with progress_lock:
+        progress = job_progress[user_id]
+        progress['done'] += 1
+        if not succeeded:
+            progress['failed'] += 1
+
+# Convert downloaded audio to MP3 in a single ffmpeg pass, returning whether it succeeded
+def convert_to_mp3(input_file, stem, output_dir):
+    mp3_output_path = os.path.join(output_dir, f"{stem}.mp3")
+    # Encode under a temporary name so a partly written file is never listed or served as a track
+    part_path = mp3_output_path + '.part'
     try:
-        logging.info(f"Converting {query} to MP3...")
-        audio = AudioSegment.from_file(input_file)
-        mp3_output_path = os.path.join(output_dir, f"{query}.mp3")
-        audio.export(mp3_output_path, format="mp3")
-        os.remove(input_file)
-        logging.info(f"Converted {query} to MP3 successfully.")
+        logging.info(f"Converting {stem} to MP3...")
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', input_file,
+                        '-vn', '-codec:a', 'libmp3lame', '-b:a', '192k', '-f', 'mp3', part_path],
+                       check=True, stdin=subprocess.DEVNULL)
+        os.replace(part_path, mp3_output_path)
+        logging.info(f"Converted {stem} to MP3 successfully.")
+        return True
     except Exception as e:
-        logging.error(f"Error converting {query} to MP3: {e}")
+        logging.error(f"Error converting {stem} to MP3: {e}")
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return False
+    finally:
+        if os.path.exists(input_file):
+            os.remove(input_file)
+
+# Convert a downloaded track and record it in the job's progress
+def convert_track(user_id, input_file, stem, output_dir):
+    finish_track(user_id, convert_to_mp3(input_file, stem, output_dir))
+
+# Build the per-track pipeline for one playlist. Everything that is the same for every track
+# is bound once here, so each download task is just process_track(stem, query).
+def make_track_pipeline(user_id, user_folder):
+    submit_conversion = convert_executor.submit
+
+    # Search and download a single track, then hand it to the conversion pool.
+    # Returns the conversion's future, or None if the track failed.
+    def process_track(stem, query):
+        try:
+            downloaded_file = None
+            # A cached video may have been taken down since; if so, forget it and search again
+            video_url = get_cached_video_url(query)
+            if video_url:
+                logging.info(f"Found cached video for '{query}': {video_url}")
+                try:
+                    downloaded_file = download_song(video_url, stem, user_folder)
+                except Exception as e:
+                    logging.warning(f"Cached video for '{query}' failed ({e}), searching again...")
+                    forget_video_url(query)
+            if downloaded_file is None:
+                try:
+                    video_url = search_youtube_api(query)
+                except Exception:
+                    video_url = search_youtube_yt_dlp(query)
+                downloaded_file = download_song(video_url, stem, user_folder)
+            return submit_conversion(convert_track, user_id, downloaded_file, stem, user_folder)
+        except Exception as e:
+            logging.error(f"Failed to download {query}: {e}")
+            finish_track(user_id, False)
+            return None
+
+    return process_track
+
+# Download every track of a playlist into the user's folder
+def download_playlist(user_id, playlist_id):
+    user_folder = os.path.join(BASE_DOWNLOAD_FOLDER, user_id)
+    try:
+        update_progress(user_id, status='downloading')
+        tracks = fetch_spotify_playlist_tracks(playlist_id)
+        # Files are named by slug; the original titles are kept alongside them
+        titles = build_track_titles(tracks)
+        # Written under a temporary name, since clients may already be polling /files/<user_id>
+        titles_path = os.path.join(user_folder, TITLES_FILENAME)
+        with open(titles_path + '.part', 'w') as f:
+            json.dump(titles, f)
+        os.replace(titles_path + '.part', titles_path)
+        update_progress(user_id, total=len(titles))
+        # Wait for every download, then for the conversions they handed off
+        process_track = make_track_pipeline(user_id, user_folder)
+        downloads = [download_executor.submit(process_track, stem, query) for stem, query in titles.items()]
+        conversions = [download.result() for download in downloads]
+        wait([conversion for conversion in conversions if conversion is not None])
+        update_progress(user_id, status='complete')
+        logging.info(f"Finished playlist for {user_id}.")
+    except Exception as e:
+        logging.error(f"Failed to download playlist for {user_id}: {e}")
+        update_progress(user_id, status='error', message=str(e))
+
+# Job worker; downloads queued playlists one at a time
+def process_jobs():
+    while True:
+        user_id, playlist_id = job_queue.get()
+        download_playlist(user_id, playlist_id)
+        job_queue.task_done()
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        playlist_url = request.form['playlist_url']
+        playlist_id = parse_playlist_id(request.form.get('playlist_url', ''))
+        if playlist_id is None:
+            return jsonify({"status": "error", "message": "Not a Spotify playlist URL."})
         user_id = str(uuid.uuid4())
         user_folder = os.path.join(BASE_DOWNLOAD_FOLDER, user_id)
         os.makedirs(user_folder, exist_ok=True)
 
-        # Start downloading tracks
+        # Queue the playlist for a job worker; clients poll /status/<user_id> for progress
+        with progress_lock:
+            job_progress[user_id] = {'status': 'queued', 'done': 0, 'failed': 0, 'total': 0}
         try:
-            tracks = fetch_spotify_playlist_tracks(playlist_url)
-            for track in tracks:
-                query = f"{track['name']} {track['artist']}"
-                try:
-                    try:
-                        video_url = search_youtube_api(query)
-                    except Exception:
-                        video_url = search_youtube_yt_dlp(query)
-                    download_song(video_url, query, user_folder)
-                except Exception as e:
-                    logging.error(f"Failed to download {query}: {e}")
-            return jsonify({"status": "success", "user_id": user_id, "message": "Download complete!"})
-        except Exception as e:
-            return jsonify({"status": "error", "message": str(e)})
+            job_queue.put_nowait((user_id, playlist_id))
+        except Full:
+            with progress_lock:
+                del job_progress[user_id]
+            os.rmdir(user_folder)
+            return jsonify({"status": "error", "message": "Too many playlists queued, please try again later."})
+        schedule_folder_cleanup(user_folder, time.time() + MAX_FILE_AGE)
+        return jsonify({"status": "queued", "user_id": user_id})
 
     return '''
     <form method="POST">
@@ -170,30 +508,109 @@ def index():
     </form>
     '''
 
+# Map a user ID to its download folder, or None if it isn't a valid ID.
+# User IDs are UUIDs; anything else (e.g. '..') must not become part of a path.
+def get_user_folder(user_id):
+    try:
+        user_id = str(uuid.UUID(user_id))
+    except ValueError:
+        return None
+    return os.path.join(BASE_DOWNLOAD_FOLDER, user_id)
+
+# List a user folder's MP3s and their track titles. Cached by the folder's mtime, which changes
+# whenever a file is added, removed or renamed, so repeated polls of an unchanged folder are free.
+@lru_cache(maxsize=1024)
+def read_user_files(user_folder, mtime_ns):
+    with os.scandir(user_folder) as entries:
+        files = tuple(entry.name for entry in entries
+                      if entry.name.endswith('.mp3') and entry.is_file(follow_symlinks=False))
+    # Report the original track title for each file
+    titles = {}
+    titles_path = os.path.join(user_folder, TITLES_FILENAME)
+    if os.path.exists(titles_path):
+        with open(titles_path, 'r') as f:
+            stem_titles = json.load(f)
+        for file in files:
+            stem = os.path.splitext(file)[0]
+            if stem in stem_titles:
+                titles[file] = stem_titles[stem]
+    return files, titles
+
+# Name a downloaded MP3 after its original track title; slugs are only used on disk
+def get_download_name(file, titles):
+    title = titles.get(file, '').replace('/', '').replace('\\', '').strip()
+    return f"{title}.mp3" if title else file
+
+@app.route('/status/<user_id>')
+def job_status(user_id):
+    if get_user_folder(user_id) is None:
+        return jsonify({"status": "error", "message": "Invalid user ID."})
+    with progress_lock:
+        progress = job_progress.get(user_id)
+        progress = dict(progress) if progress else None
+    if progress is None:
+        return jsonify({"status": "error", "message": "No job found for this user."})
+    return jsonify({"user_id": user_id, **progress})
+
 @app.route('/files/<user_id>')
 def list_files(user_id):
-    user_folder = os.path.join(BASE_DOWNLOAD_FOLDER, user_id)
-    if not os.path.exists(user_folder):
+    user_folder = get_user_folder(user_id)
+    if user_folder is None:
+        return jsonify({"status": "error", "message": "Invalid user ID."})
+    try:
+        mtime_ns = os.stat(user_folder).st_mtime_ns
+    except FileNotFoundError:
         return jsonify({"status": "error", "message": "No files found for this user."})
 
-    files = [f for f in os.listdir(user_folder) if f.endswith('.mp3')]
-    return jsonify({"files": files})
+    files, titles = read_user_files(user_folder, mtime_ns)
+    return jsonify({"files": list(files), "titles": titles})
 
 @app.route('/files/<user_id>/download_all')
 def download_all(user_id):
-    user_folder = os.path.join(BASE_DOWNLOAD_FOLDER, user_id)
-    if not os.path.exists(user_folder):
+    user_folder = get_user_folder(user_id)
+    if user_folder is None:
+        return jsonify({"status": "error", "message": "Invalid user ID."})
+    try:
+        mtime_ns = os.stat(user_folder).st_mtime_ns
+    except FileNotFoundError:
         return jsonify({"status": "error", "message": "No files found for this user."})
 
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-        for filename in os.listdir(user_folder):
-            if filename.endswith('.mp3'):
-                zip_file.write(os.path.join(user_folder, filename), filename)
-    zip_buffer.seek(0)
-    return send_file(zip_buffer, as_attachment=True, download_name=f"{user_id}_songs.zip", mimetype="application/zip")
+    # Stream the archive as it is built; MP3s are already compressed, so by default store
+    # them as-is. Deflate is opt-in with ?compress=1, at the cost of CPU and a known size.
+    compress = request.args.get('compress') == '1'
+    zip_stream = ZipStream(compress_type=ZIP_DEFLATED if compress else ZIP_STORED, sized=not compress)
+    files, titles = read_user_files(user_folder, mtime_ns)
+    for file in files:
+        zip_stream.add_path(os.path.join(user_folder, file), get_download_name(file, titles))
+    headers = {'Content-Disposition': f'attachment; filename="{user_id}_songs.zip"'}
+    if zip_stream.sized:
+        headers['Content-Length'] = str(len(zip_stream))
+    return Response(zip_stream, mimetype="application/zip", headers=headers)
 
-if __name__ == '__main__':
+@app.route('/files/<user_id>/<filename>')
+def download_file(user_id, filename):
+    user_folder = get_user_folder(user_id)
+    if user_folder is None:
+        return jsonify({"status": "error", "message": "Invalid user ID."})
+    if not filename.endswith('.mp3'):
+        return jsonify({"status": "error", "message": "Only MP3 files can be downloaded."})
+    try:
+        mtime_ns = os.stat(user_folder).st_mtime_ns
+    except FileNotFoundError:
+        return jsonify({"status": "error", "message": "No files found for this user."})
+    _, titles = read_user_files(user_folder, mtime_ns)
+    # Served as a file path, so gunicorn (or Apache/lighttpd, with X-Sendfile) can use sendfile()
+    return send_from_directory(user_folder, filename, as_attachment=True,
+                               download_name=get_download_name(filename, titles))
+
+# Start background threads (also called from gunicorn.conf.py for each worker)
+def start_background_threads():
     # Start cleanup in a separate thread
     Thread(target=cleanup_old_files, daemon=True).start()
-    app.run(host='0.0.0.0', port=8080)
+    # Start the workers that download queued playlists
+    for _ in range(MAX_CONCURRENT_PLAYLISTS):
+        Thread(target=process_jobs, daemon=True).start()
+
+if __name__ == '__main__':
+    start_background_threads()
+    app.run(host='0.0.0.0', port=8080, threaded=True)
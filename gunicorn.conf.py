@@ -0,0 +1,24 @@
+# Gunicorn configuration: gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8080')
+
+# Requests spend nearly all their time waiting on network and disk I/O,
+# so serve them from a pool of threads instead of one process per request.
+# Job progress is kept in worker memory, so /status only sees playlists
+# queued on the same worker; keep a single worker unless requests are pinned.
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+
+# Playlists download in the background, but large archives can take a while to stream
+timeout = 600
+keepalive = 5
+
+# Hand file responses to the kernel with sendfile() instead of copying them through Python
+sendfile = True
+
+def post_worker_init(worker):
+    # The __main__ block of app.py does not run under gunicorn
+    from app import start_background_threads
+    start_background_threads()